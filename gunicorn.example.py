@@ -0,0 +1,18 @@
+# Example gunicorn configuration for pluss: gunicorn -c gunicorn.example.py main:app
+#
+# The app is imported and its templates compiled once in the master process,
+# then shared by every forked worker. Database, memcache and HTTP connections
+# are opened lazily in each worker after the fork.
+
+bind = '127.0.0.1:54321'
+workers = 4
+worker_class = 'gevent'
+preload_app = True
+
+def when_ready(server):
+    from pluss.app import load_templates
+    load_templates()
+
+def post_fork(server, worker):
+    from pluss.util import lifecycle
+    lifecycle.post_fork()
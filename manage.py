@@ -0,0 +1,207 @@
+"""Command-line maintenance tasks for pluss."""
+import argparse
+import collections
+import json
+import logging
+import os
+import Queue
+import subprocess
+import sys
+import threading
+import time
+
+# Run in a fresh interpreter for each bench-startup run, so that nothing is
+# already imported or compiled. Reports timings in seconds as JSON.
+STARTUP_BENCH_SNIPPET = """
+import datetime, json, os, sys, time
+start = time.time()
+import main
+imported = time.time()
+from pluss.app import app, load_templates
+load_templates()
+loaded = time.time()
+
+from pluss.util import lifecycle
+forked = []
+for _ in range(%(workers)d):
+    read_fd, write_fd = os.pipe()
+    before_fork = time.time()
+    if os.fork() == 0:
+        os.close(read_fd)
+        lifecycle.post_fork()
+        with app.test_request_context('/'):
+            app.jinja_env.get_template('main.html').render(datetime=datetime)
+        os.write(write_fd, repr(time.time() - before_fork))
+        os._exit(0)
+    os.close(write_fd)
+    forked.append(read_fd)
+workers = []
+for read_fd in forked:
+    workers.append(float(os.read(read_fd, 64)))
+    os.close(read_fd)
+    os.wait()
+
+sys.stdout.write(json.dumps({
+    'import': imported - start,
+    'templates': loaded - imported,
+    'worker': max(workers) if workers else 0,
+}))
+"""
+
+def precompile_templates(args):
+    """Compile every template into the configured bytecode cache."""
+    from pluss.app import load_templates, template_cache_dir
+    if not template_cache_dir():
+        sys.stderr.write('No template-cache directory set in the [server] config section.\n')
+        return 1
+    start = time.time()
+    load_templates()
+    print('Compiled templates into %s in %.1fms.' % (
+        template_cache_dir(), (time.time() - start) * 1000))
+    return 0
+
+def bench_startup(args):
+    """Time app import, template loading and forked worker readiness."""
+    from pluss.app import template_cache_dir
+    root = os.path.dirname(os.path.abspath(__file__))
+    snippet = STARTUP_BENCH_SNIPPET % {'workers': args.workers}
+    results = []
+    for _ in range(args.runs):
+        output = subprocess.check_output([sys.executable, '-c', snippet], cwd=root)
+        results.append(json.loads(output))
+
+    print('%d runs, %d workers per run, bytecode cache: %s' % (
+        args.runs, args.workers, template_cache_dir() or 'disabled'))
+    for phase in ('import', 'templates', 'worker'):
+        timings = [r[phase] * 1000 for r in results]
+        print('%-10s mean %8.1fms  min %8.1fms  max %8.1fms' % (
+            phase, sum(timings) / len(timings), min(timings), max(timings)))
+    return 0
+
+def maintain_tokens(args):
+    """Refresh every stored token, pruning revoked ids and pre-seeding access tokens."""
+    from pluss.handlers import oauth2
+    from pluss.util import edge
+    from pluss.util.db import TokenIdMapping
+    from pluss.util.ratelimit import TokenBucket
+
+    total = TokenIdMapping.count()
+    counts = collections.Counter()
+    lock = threading.Lock()
+    # Token refreshes count against our API quota, so they share a rate budget.
+    budget = TokenBucket(args.rate, max(1, args.rate), time.time())
+    # Bounded, so that rows are only read from the database as fast as they're processed.
+    work = Queue.Queue(maxsize=args.concurrency * 2)
+
+    def spend_budget():
+        while True:
+            with lock:
+                wait = budget.consume(time.time())
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def check(gplus_id, refresh_token):
+        if not args.force and oauth2.get_access_token_for_id.cached(gplus_id):
+            return 'cached'
+        spend_budget()
+        try:
+            token = oauth2.refresh_access_token(gplus_id, refresh_token)
+            oauth2.get_access_token_for_id.prime((gplus_id,), token.value, ttl=token.ttl)
+        except oauth2.AccessRevokedException:
+            return 'revoked'
+        except oauth2.UnavailableException as e:
+            logging.warning('Failed to refresh token for G+ id %s: %r', gplus_id, e)
+            return 'failed'
+        return 'refreshed'
+
+    def worker():
+        while True:
+            row = work.get()
+            if row is None:
+                return
+            try:
+                result = check(*row)
+            except Exception:
+                # e.g. a locked database or a malformed token response; keep
+                # going, since a dead worker would eventually stall the whole run.
+                logging.exception('Failed to check token for G+ id %s', row[0])
+                result = 'failed'
+            with lock:
+                counts[result] += 1
+
+    start = time.time()
+    def report():
+        with lock:
+            done = sum(counts.values())
+            summary = ' '.join('%s=%d' % (k, counts[k])
+                for k in ('refreshed', 'revoked', 'failed', 'cached'))
+        elapsed = time.time() - start
+        print('%d/%d ids checked (%s) in %.1fs, %.1f ids/s' % (
+            done, total, summary, elapsed, done / elapsed if elapsed else 0))
+
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+
+    last_report = start
+    for row in TokenIdMapping.iter_all(args.batch_size):
+        work.put(row)
+        if time.time() - last_report >= args.report_interval:
+            report()
+            last_report = time.time()
+    for thread in threads:
+        work.put(None)
+    for thread in threads:
+        thread.join()
+    # Revoked ids are purged from the edge in the background; don't exit before that's done.
+    edge.flush()
+    report()
+    return 0
+
+def positive(convert):
+    """An argparse type accepting only numbers greater than zero."""
+    def parse(value):
+        try:
+            number = convert(value)
+        except ValueError:
+            number = None
+        if number is None or number <= 0:
+            raise argparse.ArgumentTypeError('must be a number greater than 0: %r' % value)
+        return number
+    return parse
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers()
+
+    precompile = subparsers.add_parser('precompile-templates', help=precompile_templates.__doc__)
+    precompile.set_defaults(func=precompile_templates)
+
+    bench = subparsers.add_parser('bench-startup', help=bench_startup.__doc__)
+    bench.add_argument('--runs', type=int, default=5)
+    bench.add_argument('--workers', type=int, default=4,
+        help='Workers to fork from each preloaded app')
+    bench.set_defaults(func=bench_startup)
+
+    tokens = subparsers.add_parser('maintain-tokens', help=maintain_tokens.__doc__)
+    tokens.add_argument('--batch-size', type=positive(int), default=500,
+        help='Rows to read from the database at a time')
+    tokens.add_argument('--concurrency', type=positive(int), default=8,
+        help='Token refreshes to run in parallel')
+    tokens.add_argument('--rate', type=positive(float), default=5.0,
+        help='Maximum token refreshes per second')
+    tokens.add_argument('--force', action='store_true',
+        help='Also refresh ids which already have a cached access token')
+    tokens.add_argument('--report-interval', type=positive(float), default=10.0,
+        help='Seconds between progress reports')
+    tokens.set_defaults(func=maintain_tokens)
+
+    args = parser.parse_args()
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -1,6 +1,8 @@
+import errno
 import os
 
 import flask
+import jinja2
 
 from pluss.util import db
 from pluss.util.config import Config
@@ -10,7 +12,40 @@ def full_url_for(*args, **kwargs):
     return  base + flask.url_for(*args, **kwargs)
 
 
+def template_cache_dir():
+    """Directory for precompiled template bytecode, or None if not configured."""
+    path = Config.getdefault('server', 'template-cache', None)
+    return path and os.path.expanduser(os.path.expandvars(path))
+
+def make_template_cache_dir():
+    """Create the template bytecode cache directory, if configured and missing."""
+    path = template_cache_dir()
+    if not path:
+        return
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        # Other workers may be creating it at the same time.
+        if e.errno != errno.EEXIST:
+            raise
+
+def load_templates():
+    """Compile every template up front (via the bytecode cache, if configured).
+
+    Calling this before forking workers lets them all share the compiled templates.
+    """
+    make_template_cache_dir()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
+# Only records the path; the database is opened lazily in each worker.
 db.init(os.path.expanduser(os.path.expandvars(Config.get('database', 'path'))))
 
 app = flask.Flask("pluss")
+if template_cache_dir():
+    app.jinja_options = dict(app.jinja_options,
+        bytecode_cache=jinja2.FileSystemBytecodeCache(template_cache_dir()))
+    # In case load_templates() wasn't called before serving.
+    app.before_first_request(make_template_cache_dir)
 import pluss.handlers
@@ -1,3 +1,5 @@
 from pluss.handlers import atom
+from pluss.handlers import jsonfeed
 from pluss.handlers import main
 from pluss.handlers import oauth2
+from pluss.handlers import rss
@@ -1,4 +1,5 @@
 import datetime
+import json
 import re
 
 import flask
@@ -7,29 +8,45 @@ import requests
 
 from pluss.app import app, full_url_for
 from pluss.handlers import oauth2
+from pluss.util import cadence
 from pluss.util import dateutils
-from pluss.util.cache import Cache
+from pluss.util import edge
+from pluss.util.admission import generation_gate
+from pluss.util.cache import Cache, Expiring, memoize
 from pluss.util.config import Config
+from pluss.util.lifecycle import ProcessLocal
 from pluss.util.ratelimit import ratelimited
+from pluss.util.renderpool import RenderError, RenderPool
 
 GPLUS_API_ACTIVITIES_ENDPOINT = 'https://www.googleapis.com/plus/v1/people/%s/activities/public'
 
-ATOM_CACHE_KEY_TEMPLATE = 'pluss--atom--1--%s'
+# Keyed on kind ('items' for the processed feed items, 'posts' for its post
+# history, or an output format), G+ id and the id's feed generation (see
+# oauth2.bump_feed_generation), plus the page id if any.
+FEED_CACHE_KEY_TEMPLATE = 'pluss--%s--3--%s--%d'
+STALE_CACHE_KEY_SUFFIX = '--stale'
 
-@ratelimited
 @app.route('/atom/<gplus_id>')
+@ratelimited
 def user_atom(gplus_id):
     """Display an Atom-format feed for a user id."""
     return atom(gplus_id)
 
-@ratelimited
 @app.route('/atom/<gplus_id>/<page_id>')
+@ratelimited
 def page_atom(gplus_id, page_id):
     """Display an Atom-format feed for a page, using a user's key."""
     return atom(gplus_id, page_id)
 
 def atom(gplus_id, page_id=None):
     """Return an Atom-format feed for the given G+ id, possibly from cache."""
+    return serve_feed('atom', render_atom, gplus_id, page_id)
+
+def serve_feed(fmt, render, gplus_id, page_id=None):
+    """Return a feed for the given G+ id in some output format, possibly from cache.
+
+    `render` turns the format-independent feed from get_feed() into a response.
+    """
 
     if len(gplus_id) != 21:
         return 'Invalid G+ user ID (must be exactly 21 digits).', 404 # Not Found
@@ -41,65 +58,175 @@ def atom(gplus_id, page_id=None):
 
     ##### CODE BELOW FOR HISTORICAL PURPOSES ONLY #####
 
-    cache_key = ATOM_CACHE_KEY_TEMPLATE % gplus_id
-    if page_id:
-        cache_key = '%s-%s' % (cache_key, page_id)
+    cache_key = feed_cache_key(fmt, gplus_id, page_id)
 
     response = Cache.get(cache_key) # A frozen Response object
-    if response is None:
+    if response is None and get_feed.cached(gplus_id, page_id):
+        # The items are already cached, so rendering them needs no upstream call.
+        response = generate_cached_response(cache_key, render, gplus_id, page_id)
+    elif response is None:
+        # Cache misses tie up a greenlet for as long as the upstream takes to
+        # respond, so only a bounded number of them may run at once.
+        gate = generation_gate.get()
+        if not gate.acquire():
+            return shed(cache_key, gplus_id, page_id, gate.retry_after)
         try:
-            response = generate_atom(gplus_id, page_id)
-        except oauth2.UnavailableException as e:
-            app.logger.info("Feed request failed - %r", e)
-            flask.abort(e.status)
-        response.add_etag()
-        response.freeze()
-        Cache.set(cache_key, response, time=Config.getint('cache', 'stream-expire'))
+            # Another request may have filled the cache while we waited.
+            response = Cache.get(cache_key)
+            if response is None:
+                response = generate_cached_response(cache_key, render, gplus_id, page_id)
+        finally:
+            gate.release()
+    edge.add_cache_headers(response, edge.surrogate_keys(gplus_id, page_id))
     return response.make_conditional(flask.request)
 
-def generate_atom(gplus_id, page_id):
-    """Generate an Atom-format feed for the given G+ id."""
+def feed_cache_key(kind, gplus_id, page_id):
+    cache_key = FEED_CACHE_KEY_TEMPLATE % (kind, gplus_id, oauth2.get_feed_generation(gplus_id))
+    if page_id:
+        cache_key = '%s-%s' % (cache_key, page_id)
+    return cache_key
+
+def feed_url(fmt, gplus_id, page_id=None):
+    """Full URL of a feed in the given output format."""
+    if page_id:
+        return full_url_for('page_%s' % fmt, gplus_id=gplus_id, page_id=page_id)
+    return full_url_for('user_%s' % fmt, gplus_id=gplus_id)
+
+def generate_cached_response(cache_key, render, gplus_id, page_id):
+    """Render a feed and store it in the cache, plus a longer-lived stale copy."""
+    try:
+        feed = get_feed(gplus_id, page_id)
+    except oauth2.UnavailableException as e:
+        app.logger.info("Feed request failed - %r", e)
+        flask.abort(e.status)
+    response = render(feed, gplus_id, page_id)
+    # Rendered copies expire along with the items they were rendered from.
+    response.expires = feed['expires']
+    expire = max(1, int((feed['expires'] - datetime.datetime.utcnow()).total_seconds()))
+    response.add_etag()
+    response.freeze()
+    Cache.set(cache_key, response, time=expire)
+    Cache.set(cache_key + STALE_CACHE_KEY_SUFFIX, response,
+        time=Config.getdefault('cache', 'stale-expire', 86400, 'getint'))
+    return response
+
+def shed(cache_key, gplus_id, page_id, retry_after):
+    """Respond to a request turned away by admission control."""
+    response = Cache.get(cache_key + STALE_CACHE_KEY_SUFFIX)
+    if response is not None:
+        response.headers['Warning'] = '110 - "Response is Stale"'
+        edge.add_cache_headers(response, edge.surrogate_keys(gplus_id, page_id))
+        return response.make_conditional(flask.request)
+    message = 'Too many feeds are being generated right now. Please try again later.'
+    return message, 503, {'Retry-After': str(retry_after)} # Service Unavailable
+
+# Upstream failures are cached briefly, so that they aren't retried on every request.
+# Successful results carry their own TTL (see feed_expire()).
+@memoize(lambda gplus_id, page_id: feed_cache_key('items', gplus_id, page_id),
+    ttl=Config.getint('cache', 'stream-expire'), negative=(oauth2.UnavailableException,))
+def get_feed(gplus_id, page_id):
+    """Return the processed items for a G+ id, possibly from cache.
+
+    The result doesn't depend on the output format, so a single upstream
+    fetch serves every format. How long it is cached for depends on how
+    often the feed is updated.
+    """
+    feed = generate_feed(gplus_id, page_id)
+    expire = feed_expire(gplus_id, page_id, feed)
+    feed['expires'] = datetime.datetime.utcnow() + datetime.timedelta(seconds=expire)
+    # Any copy still held at the edge, in any format, is now out of date.
+    edge.purge([edge.feed_key(gplus_id, page_id)])
+    return Expiring(feed, expire)
+
+def feed_expire(gplus_id, page_id, feed):
+    """Choose a cache TTL for a feed from its recent post times."""
+    # Publication rather than update times, which also move on edits and activity.
+    timestamps = [item['published'] for item in feed['items']]
+    if timestamps:
+        history_key = feed_cache_key('posts', gplus_id, page_id)
+        timestamps = cadence.record_posts(history_key, timestamps)
+    return cadence.choose_ttl(timestamps, datetime.datetime.utcnow(),
+        default=Config.getint('cache', 'stream-expire'),
+        minimum=Config.getdefault('cache', 'stream-expire-min', 300, 'getint'),
+        maximum=Config.getdefault('cache', 'stream-expire-max', 21600, 'getint'),
+        factor=Config.getdefault('cache', 'stream-expire-factor', 0.1, 'getfloat'))
+
+def generate_feed(gplus_id, page_id):
+    """Fetch the public activities for the given G+ id and process them into feed items."""
     # If no page id specified, use the special value 'me' which refers to the
     # stream for the owner of the OAuth2 token.
     request = requests.Request('GET', GPLUS_API_ACTIVITIES_ENDPOINT % (page_id or 'me'),
         params={'maxResults': 10, 'userIp': flask.request.remote_addr})
     api_response = oauth2.authed_request_for_id(gplus_id, request)
-    result = api_response.json()
+    return process_feed(api_response.content, page_id or gplus_id)
+
+def process_feed(raw, feed_id):
+    """Turn a raw API response into feed items, in a render process if it's large enough."""
+    pool = render_pool.get()
+    if pool is None or len(raw) < Config.getdefault('render', 'inline-threshold', 16384, 'getint'):
+        return build_feed(raw, feed_id)
+    try:
+        return pool.apply(raw, feed_id)
+    except RenderError as e:
+        app.logger.error('Rendering feed %s failed: %s', feed_id, e)
+        raise oauth2.UnavailableException('Failed to render feed %s.' % feed_id, 502)
+
+def build_feed_in_app_context(raw, feed_id):
+    """Entry point for render processes, which have no app context of their own."""
+    with app.app_context():
+        return build_feed(raw, feed_id)
+
+def create_render_pool():
+    processes = Config.getdefault('render', 'processes', 0, 'getint')
+    if not processes:
+        return None
+    return RenderPool(processes, build_feed_in_app_context,
+        timeout=Config.getdefault('render', 'timeout', 10.0, 'getfloat'))
 
-    if page_id:
-        request_url = full_url_for('page_atom', gplus_id=gplus_id, page_id=page_id)
-    else:
-        request_url = full_url_for('user_atom', gplus_id=gplus_id)
+# Created lazily in each worker, so that render processes are never shared
+# between workers. None if rendering in separate processes is disabled.
+render_pool = ProcessLocal(create_render_pool)
+
+def build_feed(raw, feed_id):
+    """Decode a raw API response and process its items (CPU-bound)."""
+    result = json.loads(raw)
 
-    params = {
-        'server_url': full_url_for('main'),
-        'feed_id': page_id or gplus_id,
-        'request_url': request_url,
-        'to_atom_date': dateutils.to_atom_format,
+    feed = {
+        'feed_id': feed_id,
+        'items': [],
+        'actor': None,
     }
 
     items = result.get('items')
     if not items:
-        params['last_update'] = datetime.datetime.today()
-        body = flask.render_template('atom/empty.xml', **params)
+        feed['last_update'] = datetime.datetime.today()
     else:
-        last_update = max(dateutils.from_iso_format(item['updated']) for item in items)
-        params['last_update'] = last_update
-        params['items'] = process_feed_items(items)
-        params['actor'] = params['items'][0]['actor']
-        body = flask.render_template('atom/feed.xml', **params)
+        feed['last_update'] = max(dateutils.from_iso_format(item['updated']) for item in items)
+        feed['items'] = process_feed_items(items)
+        feed['actor'] = feed['items'][0]['actor']
+    return feed
+
+def render_atom(feed, gplus_id, page_id):
+    """Render an Atom-format feed from the result of get_feed()."""
+    params = dict(feed,
+        server_url=full_url_for('main'),
+        request_url=feed_url('atom', gplus_id, page_id),
+        to_atom_date=dateutils.to_atom_format,
+    )
+    template = 'atom/feed.xml' if feed['items'] else 'atom/empty.xml'
+    body = flask.render_template(template, **params)
 
     response = flask.make_response(body)
     response.headers['Content-Type'] = 'application/atom+xml; charset=utf-8'
-    response.date = params['last_update']
+    response.date = feed['last_update']
     return response
 
 def process_feed_items(api_items):
-    """Generate a list of items for use in an Atom feed template from an API result."""
+    """Generate a list of items for use in a feed template from an API result."""
     return [process_feed_item(item) for item in api_items]
 
 def process_feed_item(api_item):
-    """Generate a single item for use in an Atom feed template from an API result."""
+    """Generate a single item for use in a feed template from an API result."""
     # Begin with the fields shared by all feed items.
     item = {
         'id': api_item['id'],
@@ -0,0 +1,68 @@
+import json
+
+import flask
+import jinja2
+
+from pluss.app import app
+from pluss.handlers.atom import feed_url, serve_feed
+from pluss.util import dateutils
+from pluss.util.ratelimit import ratelimited
+
+JSON_FEED_VERSION = 'https://jsonfeed.org/version/1.1'
+
+@app.route('/json/<gplus_id>')
+@ratelimited
+def user_json(gplus_id):
+    """Display a JSON Feed for a user id."""
+    return serve_feed('json', render_json, gplus_id)
+
+@app.route('/json/<gplus_id>/<page_id>')
+@ratelimited
+def page_json(gplus_id, page_id):
+    """Display a JSON Feed for a page, using a user's key."""
+    return serve_feed('json', render_json, gplus_id, page_id)
+
+def render_json(feed, gplus_id, page_id):
+    """Render a JSON Feed from the result of atom.get_feed()."""
+    home_page_url = 'https://plus.google.com/%s' % feed['feed_id']
+    result = {
+        'version': JSON_FEED_VERSION,
+        'home_page_url': home_page_url,
+        'feed_url': feed_url('json', gplus_id, page_id),
+        'language': 'en',
+    }
+
+    actor = feed['actor']
+    if actor:
+        result['title'] = '%s - Google+ Public Posts' % actor['name']
+        author = {'name': actor['name'], 'url': actor['url'], 'avatar': actor['image_url']}
+        result['authors'] = [dict((k, v) for k, v in author.items() if v)]
+        if actor['image_url']:
+            result['icon'] = actor['image_url']
+    else:
+        result['title'] = 'No items found for %s' % feed['feed_id']
+
+    items = [{
+        'id': item['id'],
+        'url': item['permalink'],
+        'title': jinja2.Markup(item['title']).striptags(),
+        'content_html': item['content'],
+        'date_published': dateutils.to_atom_format(item['published']),
+        'date_modified': dateutils.to_atom_format(item['updated']),
+    } for item in feed['items']]
+    if not items:
+        items.append({
+            'id': home_page_url,
+            'url': home_page_url,
+            'title': 'No Public Items Found',
+            'content_text': 'G+ user %s has not made any posts public.' % feed['feed_id'],
+            'date_published': dateutils.to_atom_format(feed['last_update']),
+        })
+    result['items'] = items
+
+    response = flask.make_response(json.dumps(result))
+    response.headers['Content-Type'] = 'application/feed+json; charset=utf-8'
+    response.date = feed['last_update']
+    return response
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -1,4 +1,5 @@
 import datetime
+import time
 import urllib
 import pprint
 
@@ -6,9 +7,11 @@ import flask
 import requests
 
 from pluss.app import app, full_url_for
-from pluss.util.cache import Cache
+from pluss.util import edge
+from pluss.util.cache import Cache, Expiring, memoize
 from pluss.util.config import Config
 from pluss.util.db import TokenIdMapping
+from pluss.util.lifecycle import ProcessLocal
 
 GOOGLE_API_TIMEOUT = 5
 
@@ -17,11 +20,16 @@ OAUTH2_SCOPE = 'https://www.googleapis.com/auth/plus.me'
 
 GPLUS_API_ME_ENDPOINT = 'https://www.googleapis.com/plus/v1/people/me'
 
-ACCESS_TOKEN_CACHE_KEY_TEMPLATE = 'pluss--gplusid--oauth--1--%s'
-PROFILE_CACHE_KEY_TEMPLATE = 'pluss--gplusid--profile--1--%s'
+ACCESS_TOKEN_CACHE_KEY_TEMPLATE = 'pluss--gplusid--oauth--2--%s'
+PROFILE_CACHE_KEY_TEMPLATE = 'pluss--gplusid--profile--2--%s'
+FEED_GENERATION_CACHE_KEY_TEMPLATE = 'pluss--gplusid--feedgen--1--%s'
 
-# Shared session to allow persistent connection pooling
-session = requests.Session()
+# Shared session to allow persistent connection pooling (one per process,
+# since pooled connections must not be shared across forks)
+_session = ProcessLocal(requests.Session)
+
+def session():
+    return _session.get()
 
 @app.route("/auth")
 def auth():
@@ -71,7 +79,7 @@ def oauth2():
         'grant_type': 'authorization_code',
     }
     try:
-        response = session.post(OAUTH2_BASE + '/token', data, timeout=GOOGLE_API_TIMEOUT)
+        response = session().post(OAUTH2_BASE + '/token', data, timeout=GOOGLE_API_TIMEOUT)
     except requests.exceptions.Timeout:
         app.logger.error('OAuth2 token request timed out.')
         # TODO: handle this better (flash message?)
@@ -126,7 +134,12 @@ def oauth2():
 
     # Convert the absolute expiry timestamp back into a duration in seconds
     expires_in = int((expiry - datetime.datetime.today()).total_seconds())
-    Cache.set(ACCESS_TOKEN_CACHE_KEY_TEMPLATE % person['id'], access_token, time=expires_in)
+    # These also replace any cached failures from before the user authorized us.
+    get_access_token_for_id.prime((person['id'],), access_token, ttl=expires_in)
+    get_person_by_id.prime((person['id'],), person)
+    # Cached feed failures (e.g. "No tokens" or a revoke) are keyed on the feed
+    # generation, so this drops them for the user's own feed and any page feeds.
+    bump_feed_generation(person['id'])
 
     # Whew, all done! Set a cookie with the user's G+ id and send them back to the homepage.
     app.logger.info("Successfully authenticated G+ id %s.", person['id'])
@@ -144,46 +157,45 @@ class UnavailableException(Exception):
         super(UnavailableException, self).__init__(message, status, *args, **kwargs)
         self.status = status
 
+# Raised when a user turns out to have revoked pluss' access to their account.
+class AccessRevokedException(UnavailableException):
+    pass
+
 def get_person_by_access_token(token):
     """Fetch details about an individual from the G+ API and return a dict with the response."""
     headers = {
         'Authorization': 'Bearer %s' % token,
     }
     try:
-        response = session.get(GPLUS_API_ME_ENDPOINT, headers=headers, timeout=GOOGLE_API_TIMEOUT)
+        response = session().get(GPLUS_API_ME_ENDPOINT, headers=headers, timeout=GOOGLE_API_TIMEOUT)
         person = response.json()
     except requests.exceptions.Timeout:
         raise UnavailableException('Person API request timed out.', 504)
     except Exception as e:
         raise UnavailableException('Person API request raised exception "%r" for %s.' % (e, pprint.pformat(response).text), 502)
-
-    Cache.set(PROFILE_CACHE_KEY_TEMPLATE % person['id'], person,
-        time=Config.getint('cache', 'profile-expire'))
     return person
 
+@memoize(PROFILE_CACHE_KEY_TEMPLATE, ttl=Config.getint('cache', 'profile-expire'),
+    negative=(UnavailableException,))
 def get_person_by_id(gplus_id):
-    """A proxy for fetch_person_by_access_token that resolves an id into an access token first."""
-    # Check the cache first.
-    person = Cache.get(PROFILE_CACHE_KEY_TEMPLATE % gplus_id)
-    if person:
-        return person
-
-    # If we don't have them cached, try to get an access token.
+    """A proxy for get_person_by_access_token that resolves an id into an access token first."""
     access_token = get_access_token_for_id(gplus_id)
-    return get_person_by_token(access_token)
+    return get_person_by_access_token(access_token)
 
+# Failures are cached briefly too, so that repeated requests for ids we have no
+# (valid) tokens for don't each cost a database lookup and a token refresh.
+@memoize(ACCESS_TOKEN_CACHE_KEY_TEMPLATE, ttl=3600, negative=(UnavailableException,))
 def get_access_token_for_id(gplus_id):
     """Get an access token for an id, potentially via refresh token if necessary."""
-    # Check the cache first.
-    token = Cache.get(ACCESS_TOKEN_CACHE_KEY_TEMPLATE % gplus_id)
-    if token:
-        return token
-
     # If we don't have a cached token, see if we have a refresh token available.
     refresh_token = TokenIdMapping.lookup_refresh_token(gplus_id)
     if not refresh_token:
         raise UnavailableException('No tokens available for G+ id %s.' % gplus_id, 401)
 
+    return refresh_access_token(gplus_id, refresh_token)
+
+def refresh_access_token(gplus_id, refresh_token):
+    """Exchange a refresh token for a new access token (as an Expiring), forgetting the id if revoked."""
     data = {
         'client_id': Config.get('oauth', 'client-id'),
         'client_secret': Config.get('oauth', 'client-secret'),
@@ -191,7 +203,7 @@ def get_access_token_for_id(gplus_id):
         'grant_type': 'refresh_token',
     }
     try:
-        response = session.post(OAUTH2_BASE + '/token', data=data, timeout=GOOGLE_API_TIMEOUT)
+        response = session().post(OAUTH2_BASE + '/token', data=data, timeout=GOOGLE_API_TIMEOUT)
         result = response.json()
     except requests.exceptions.Timeout:
         raise UnavailableException('Access token API request timed out.', 504)
@@ -201,10 +213,13 @@ def get_access_token_for_id(gplus_id):
     if 'invalid_grant' in result or ('error' in result and result['error'] == 'invalid_grant'):
         # The provided refresh token is invalid which means the user has revoked
         # access to their content - thus, pluss should forget about them.
-        Cache.delete(ACCESS_TOKEN_CACHE_KEY_TEMPLATE % gplus_id)
-        Cache.delete(PROFILE_CACHE_KEY_TEMPLATE % gplus_id)
+        get_access_token_for_id.invalidate(gplus_id)
+        get_person_by_id.invalidate(gplus_id)
         TokenIdMapping.remove_id(gplus_id)
-        raise UnavailableException('Access revoked for G+ id %s.' % gplus_id, 502)
+        # Drop our cached feeds before the edge's, or the edge would just re-cache them.
+        bump_feed_generation(gplus_id)
+        edge.purge(edge.surrogate_keys(gplus_id))
+        raise AccessRevokedException('Access revoked for G+ id %s.' % gplus_id, 502)
     elif response.status_code != 200:
         app.logger.error('Non-200 response to access token refresh request (%s): "%r".',
             response.status_code, result)
@@ -213,9 +228,18 @@ def get_access_token_for_id(gplus_id):
         app.logger.error('Unknown token type "%s" refreshed for G+ id %s.', result.get('token_type'), gplus_id)
         raise UnavailableException('Failed to refresh access token for G+ id %s.' % gplus_id, 502)
 
-    token = result['access_token']
-    Cache.set(ACCESS_TOKEN_CACHE_KEY_TEMPLATE % gplus_id, token, time=result['expires_in'])
-    return token
+    return Expiring(result['access_token'], result['expires_in'])
+
+def get_feed_generation(gplus_id):
+    """Return the generation of an id's cached feeds, which is part of their cache keys."""
+    return Cache.get(FEED_GENERATION_CACHE_KEY_TEMPLATE % gplus_id) or 0
+
+def bump_feed_generation(gplus_id):
+    """Abandon every cached feed for an id (all pages, formats and stale copies)."""
+    # A timestamp rather than a counter, so that a bump never needs the old value.
+    # If memcache evicts it, keys fall back to generation 0, but since it is read on
+    # every feed request for the id it stays hotter than the feeds it guards.
+    Cache.set(FEED_GENERATION_CACHE_KEY_TEMPLATE % gplus_id, int(time.time() * 1000))
 
 def authed_request_for_id(gplus_id, request):
     """Adds the proper access credentials for the specified user and then makes an HTTP request."""
@@ -225,12 +249,12 @@ def authed_request_for_id(gplus_id, request):
         token = get_access_token_for_id(gplus_id)
         request.headers['Authorization'] = 'Bearer %s' % token
         prepared_request = request.prepare()
-        response = session.send(prepared_request, timeout=GOOGLE_API_TIMEOUT)
+        response = session().send(prepared_request, timeout=GOOGLE_API_TIMEOUT)
         if response.status_code == 401:
             # Our access token is invalid. If this is the first failure,
             # try forcing a refresh of the access token.
             if retry:
-                Cache.delete(ACCESS_TOKEN_CACHE_KEY_TEMPLATE % gplus_id)
+                get_access_token_for_id.invalidate(gplus_id)
                 return make_request(retry=False)
         return response
 
@@ -0,0 +1,35 @@
+import flask
+
+from pluss.app import app, full_url_for
+from pluss.handlers.atom import feed_url, serve_feed
+from pluss.util import dateutils
+from pluss.util.ratelimit import ratelimited
+
+@app.route('/rss/<gplus_id>')
+@ratelimited
+def user_rss(gplus_id):
+    """Display an RSS 2.0 feed for a user id."""
+    return serve_feed('rss', render_rss, gplus_id)
+
+@app.route('/rss/<gplus_id>/<page_id>')
+@ratelimited
+def page_rss(gplus_id, page_id):
+    """Display an RSS 2.0 feed for a page, using a user's key."""
+    return serve_feed('rss', render_rss, gplus_id, page_id)
+
+def render_rss(feed, gplus_id, page_id):
+    """Render an RSS 2.0 feed from the result of atom.get_feed()."""
+    params = dict(feed,
+        server_url=full_url_for('main'),
+        request_url=feed_url('rss', gplus_id, page_id),
+        to_rss_date=dateutils.to_http_format, # RFC 822, as RSS requires
+    )
+    template = 'rss/feed.xml' if feed['items'] else 'rss/empty.xml'
+    body = flask.render_template(template, **params)
+
+    response = flask.make_response(body)
+    response.headers['Content-Type'] = 'application/rss+xml; charset=utf-8'
+    response.date = feed['last_update']
+    return response
+
+# vim: set ts=4 sts=4 sw=4 et:
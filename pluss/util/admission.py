@@ -0,0 +1,64 @@
+import threading
+import time
+
+from pluss.util.config import Config
+from pluss.util.lifecycle import ProcessLocal
+
+class AdmissionGate(object):
+    """Bounds how many expensive operations a worker runs at once.
+
+    Up to `max_active` callers are admitted immediately. Up to `max_waiting`
+    more may wait, for at most `wait_timeout` seconds, for a slot to free up.
+    Anyone else is turned away straight away, so that a slow upstream can't
+    pile up an unbounded queue of requests in the worker.
+    """
+
+    def __init__(self, max_active, max_waiting, wait_timeout, retry_after):
+        self.max_active = max_active
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self.waiting = 0
+        self.condition = threading.Condition()
+
+    @classmethod
+    def from_config(cls):
+        return cls(
+            max_active=Config.getdefault('admission', 'max-active', 8, 'getint'),
+            max_waiting=Config.getdefault('admission', 'max-waiting', 16, 'getint'),
+            wait_timeout=Config.getdefault('admission', 'wait-timeout', 1.0, 'getfloat'),
+            retry_after=Config.getdefault('admission', 'retry-after', 10, 'getint'))
+
+    def acquire(self):
+        """Try to take a slot. Returns False if the caller should be shed instead."""
+        with self.condition:
+            if self.active < self.max_active:
+                self.active += 1
+                return True
+            if self.waiting >= self.max_waiting:
+                return False
+
+            self.waiting += 1
+            try:
+                deadline = time.time() + self.wait_timeout
+                while self.active >= self.max_active:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(remaining)
+                self.active += 1
+                return True
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self.condition:
+            self.active -= 1
+            self.condition.notify()
+
+# Bounds concurrent cache-miss feed generations in each worker.
+generation_gate = ProcessLocal(AdmissionGate.from_config)
+
+
+# vim: set ts=4 sts=4 sw=4 et:
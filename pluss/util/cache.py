@@ -1,8 +1,8 @@
-import hashlib
-import json
+import functools
 import logging
 
 from pluss.util.config import Config
+from pluss.util.lifecycle import ProcessLocal
 
 if Config.getboolean('cache', 'memcache'):
 	try:
@@ -16,53 +16,123 @@ else:
 	memcache = None
 
 class Cache(object):
-	"""Wrapper around a singleton memcache client.
+	"""Wrapper around a per-process memcache client.
 
 	Note: If the 'memcache' library is not available,
-	this wrapper will do nothing - call() will transparently
-	always call the provided function, and everything else
-	will simply return None.
+	this wrapper will do nothing - everything will simply
+	return None, and memoized functions will always be called.
 	"""
 
-	client = memcache and memcache.Client([Config.get('cache', 'memcache-uri')], debug=0)
+	# Created on first use in each process, so that preforked workers never share sockets.
+	_client = ProcessLocal(lambda: memcache and memcache.Client(
+		[Config.get('cache', 'memcache-uri')], debug=0))
 
 	@classmethod
-	def call(cls, func, *args, **kwargs):
-		if not cls.client:
-			return func(*args, **kwargs)
-
-		call_dump = json.dumps([func.__module__, func.__name__, args, kwargs])
-		memcache_key = str('pluss--%s' % hashlib.md5(call_dump).hexdigest())
-		result = cls.client.get(memcache_key)
-		if not result:
-			result = func(*args, **kwargs)
-			cls.client.set(memcache_key, result)
-		return result
+	def client(cls):
+		return cls._client.get()
 
 	@classmethod
 	def get(cls, *args, **kwargs):
 		args = (str(args[0]),) + args[1:]
-		return cls.client and cls.client.get(*args, **kwargs)
+		client = cls.client()
+		return client and client.get(*args, **kwargs)
 
 	@classmethod
 	def set(cls, *args, **kwargs):
 		args = (str(args[0]),) + args[1:]
-		return cls.client and cls.client.set(*args, **kwargs)
+		client = cls.client()
+		return client and client.set(*args, **kwargs)
+
+	@classmethod
+	def add(cls, *args, **kwargs):
+		args = (str(args[0]),) + args[1:]
+		client = cls.client()
+		return client and client.add(*args, **kwargs)
 
 	@classmethod
 	def delete(cls, *args, **kwargs):
 		args = (str(args[0]),) + args[1:]
-		return cls.client and cls.client.delete(*args, **kwargs)
+		client = cls.client()
+		return client and client.delete(*args, **kwargs)
 
 	@classmethod
 	def incr(cls, *args, **kwargs):
 		args = (str(args[0]),) + args[1:]
-		return cls.client and cls.client.incr(*args, **kwargs)
+		client = cls.client()
+		return client and client.incr(*args, **kwargs)
 
 	@classmethod
 	def decr(cls, *args, **kwargs):
 		args = (str(args[0]),) + args[1:]
-		return cls.client and cls.client.decr(*args, **kwargs)
+		client = cls.client()
+		return client and client.decr(*args, **kwargs)
+
+
+class Expiring(object):
+	"""Returned by a memoized function to cache a result for its own TTL (in seconds)."""
+
+	__slots__ = ('value', 'ttl')
+
+	def __init__(self, value, ttl):
+		self.value = value
+		self.ttl = ttl
+
+def memoize(key, ttl, negative=(), negative_ttl=None):
+	"""Cache a function's results in memcache.
+
+	`key` is either a template which is %-formatted with the function's
+	arguments, or a function taking the same arguments and returning the key.
+	Results are cached for `ttl` seconds (or their own, if the function returns
+	an Expiring), falsy ones included. Exceptions of the types listed in
+	`negative` are cached for `negative_ttl` seconds, and re-raised by calls
+	made in the meantime.
+
+	The memoized function also gets prime(args, value, ttl=None) and
+	invalidate(*args) for updating its cache from elsewhere, plus cached(*args)
+	to check whether it has a successful result cached.
+	"""
+	if negative_ttl is None:
+		negative_ttl = Config.getdefault('cache', 'negative-expire', 60, 'getint')
+	make_key = key if callable(key) else (lambda *args: key % args)
+
+	def decorator(func):
+		@functools.wraps(func)
+		def wrapper(*args):
+			cache_key = make_key(*args)
+			entry = Cache.get(cache_key)
+			if entry is not None:
+				ok, value = entry
+				if not ok:
+					raise value
+				return value
+
+			try:
+				value = func(*args)
+			except negative as e:
+				Cache.set(cache_key, (False, e), time=negative_ttl)
+				raise
+			time = ttl
+			if isinstance(value, Expiring):
+				value, time = value.value, value.ttl
+			Cache.set(cache_key, (True, value), time=time)
+			return value
+
+		def prime(args, value, ttl=None):
+			Cache.set(make_key(*args), (True, value), time=ttl if ttl is not None else wrapper.ttl)
+
+		def invalidate(*args):
+			Cache.delete(make_key(*args))
+
+		def cached(*args):
+			entry = Cache.get(make_key(*args))
+			return entry is not None and entry[0]
+
+		wrapper.ttl = ttl
+		wrapper.prime = prime
+		wrapper.invalidate = invalidate
+		wrapper.cached = cached
+		return wrapper
+	return decorator
 
 
 # vim: set ts=4 sts=4 sw=4 et:
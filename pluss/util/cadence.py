@@ -0,0 +1,38 @@
+from pluss.util.cache import Cache
+
+# How many of a feed's most recent post times to remember, and for how long.
+HISTORY_SIZE = 20
+HISTORY_EXPIRE = 30 * 24 * 60 * 60
+
+def record_posts(cache_key, timestamps):
+    """Add a feed's post times to its history, returning the whole history."""
+    history = Cache.get(cache_key) or []
+    merged = sorted(set(history) | set(timestamps))[-HISTORY_SIZE:]
+    if merged != history:
+        Cache.set(cache_key, merged, time=HISTORY_EXPIRE)
+    return merged
+
+def choose_ttl(timestamps, now, default, minimum, maximum, factor):
+    """Pick how long to cache a feed for, based on when it recently posted.
+
+    Feeds are cached for `factor` times their average gap between posts
+    (the span of the post times over the number of gaps, so that a burst of
+    posts doesn't count as a busy feed), within [minimum, maximum] seconds.
+    The time since the latest post is also a lower bound on that gap, so
+    that a feed which has gone quiet backs off. Without at least two distinct
+    post times, `default` is used instead, unless the quiet time calls for
+    longer (still within the bounds).
+    """
+    stamps = sorted(set(timestamps))
+    if not stamps:
+        return int(max(minimum, min(maximum, default)))
+    quiet = (now - stamps[-1]).total_seconds()
+    if len(stamps) < 2:
+        ttl = max(default, factor * quiet)
+    else:
+        gap = (stamps[-1] - stamps[0]).total_seconds() / (len(stamps) - 1)
+        ttl = factor * max(gap, quiet)
+    return int(max(minimum, min(maximum, ttl)))
+
+
+# vim: set ts=4 sts=4 sw=4 et:
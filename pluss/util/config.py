@@ -1,5 +1,14 @@
 import ConfigParser
 import os
 
-Config = ConfigParser.SafeConfigParser()
+class PlussConfig(ConfigParser.SafeConfigParser):
+	"""SafeConfigParser with support for optional settings."""
+
+	def getdefault(self, section, option, default, getter='get'):
+		"""Return an option via the named getter, or default if it isn't set."""
+		if not self.has_option(section, option):
+			return default
+		return getattr(self, getter)(section, option)
+
+Config = PlussConfig()
 Config.read('pluss.cfg')
@@ -5,19 +5,28 @@ import sqlite3
 # now, this works.
 
 global_db_path = None
+tables_created = False
 
 def init(db_path):
-        global global_db_path
-        global_db_path = db_path
+	"""Record where the database lives. Nothing is opened until it is first used."""
+	global global_db_path, tables_created
+	global_db_path = db_path
+	tables_created = False
 
-	# Create tables
-	TokenIdMapping.create()
+def connect():
+	"""Open a connection to the database, creating tables on first use."""
+	global tables_created
+	conn = sqlite3.connect(global_db_path)
+	if not tables_created:
+		# Create tables
+		TokenIdMapping.create(conn)
+		tables_created = True
+	return conn
 
 class TokenIdMapping(object):
 
 	@classmethod
-	def create(cls):
-                conn = sqlite3.connect(global_db_path)
+	def create(cls, conn):
 		conn.execute("""
 			CREATE TABLE IF NOT EXISTS token_id_mapping (
 				person_id TEXT,
@@ -28,7 +37,7 @@ class TokenIdMapping(object):
 
 	@classmethod
 	def update_refresh_token(cls, id, token):
-                conn = sqlite3.connect(global_db_path)
+		conn = connect()
 		conn.execute("""
 			INSERT OR REPLACE INTO token_id_mapping
 			(person_id, refresh_token) VALUES (?, ?)
@@ -37,7 +46,7 @@ class TokenIdMapping(object):
 
 	@classmethod
 	def lookup_refresh_token(cls, id):
-                conn = sqlite3.connect(global_db_path)
+		conn = connect()
 		cursor = conn.execute("""
 			SELECT refresh_token
 			FROM token_id_mapping
@@ -50,9 +59,40 @@ class TokenIdMapping(object):
 		conn.rollback()
 		return row[0] if row else None
 
+	@classmethod
+	def count(cls):
+		conn = connect()
+		row = conn.execute("SELECT COUNT(*) FROM token_id_mapping").fetchone()
+		conn.rollback()
+		return row[0]
+
+	@classmethod
+	def iter_all(cls, batch_size=1000):
+		"""Yield every (person_id, refresh_token) pair, reading batch_size rows at a time.
+
+		Pages by person_id rather than holding a cursor open, so rows may safely be
+		updated or removed while iterating.
+		"""
+		conn = connect()
+		last_id = ''
+		while True:
+			rows = conn.execute("""
+				SELECT person_id, refresh_token
+				FROM token_id_mapping
+				WHERE person_id > ?
+				ORDER BY person_id
+				LIMIT ?
+			""", (last_id, batch_size)).fetchall()
+			conn.rollback()
+			if not rows:
+				return
+			for row in rows:
+				yield row
+			last_id = rows[-1][0]
+
 	@classmethod
 	def remove_id(cls, id):
-                conn = sqlite3.connect(global_db_path)
+		conn = connect()
 		cursor = conn.execute("""
 			DELETE FROM token_id_mapping
 			WHERE person_id = ?
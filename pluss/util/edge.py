@@ -0,0 +1,104 @@
+import datetime
+import Queue
+import threading
+
+import requests
+
+from pluss.app import app
+from pluss.util.config import Config
+from pluss.util.lifecycle import ProcessLocal
+
+# Functions called with a list of surrogate keys whenever content tagged
+# with those keys changes or must disappear.
+purgers = []
+# Purges waiting to be sent; beyond this many, new ones are dropped.
+PURGE_QUEUE_SIZE = 1000
+
+_session = ProcessLocal(requests.Session)
+
+def purger(func):
+    """Register a function to be called with surrogate keys that should be purged."""
+    purgers.append(func)
+    return func
+
+def purge(keys):
+    """Ask every registered purger to drop content tagged with any of the keys.
+
+    Purges are sent in the order they were asked for, by a background thread
+    (a greenlet, under gevent), so that callers never wait on the edge.
+    """
+    try:
+        _queue.get().put_nowait(keys)
+    except Queue.Full:
+        app.logger.warning('Edge purge queue is full; dropping purge of %r.', keys)
+
+def flush():
+    """Wait until every purge asked for so far has been sent."""
+    _queue.get().join()
+
+def send_purges(queue):
+    while True:
+        keys = queue.get()
+        for func in purgers:
+            try:
+                func(keys)
+            except Exception:
+                app.logger.exception('Edge purge of %r failed.', keys)
+        queue.task_done()
+
+def start_purging():
+    queue = Queue.Queue(maxsize=PURGE_QUEUE_SIZE)
+    thread = threading.Thread(target=send_purges, args=(queue,), name='edge-purge')
+    thread.daemon = True
+    thread.start()
+    return queue
+
+# Each worker sends its own purges, so a forked worker starts a fresh thread.
+_queue = ProcessLocal(start_purging)
+
+def feed_key(gplus_id, page_id=None):
+    """Surrogate key for exactly one feed."""
+    if page_id:
+        return 'feed-%s-%s' % (gplus_id, page_id)
+    return 'feed-%s' % gplus_id
+
+def surrogate_keys(gplus_id, page_id=None):
+    """Surrogate keys for a feed, so it can be purged by itself, by G+ id or by page id."""
+    keys = [feed_key(gplus_id, page_id), 'gplus-%s' % gplus_id]
+    if page_id:
+        keys.append('page-%s' % page_id)
+    return keys
+
+def add_cache_headers(response, keys):
+    """Let shared caches keep a response until it would expire from our own cache.
+
+    The remaining lifetime comes from the response's Expires header, which is
+    set when the response is generated.
+    """
+    max_age = 0
+    if response.expires:
+        remaining = response.expires - datetime.datetime.utcnow()
+        max_age = max(0, int(remaining.total_seconds()))
+    response.cache_control.public = True
+    response.cache_control.max_age = max_age
+    response.headers['Surrogate-Control'] = 'max-age=%d' % max_age
+    response.headers[surrogate_key_header()] = ' '.join(keys)
+    return response
+
+def surrogate_key_header():
+    return Config.getdefault('edge', 'surrogate-key-header', 'Surrogate-Key')
+
+@purger
+def http_purge(keys):
+    """Send an HTTP PURGE for the keys to the configured edge cache, if any."""
+    url = Config.getdefault('edge', 'purge-url', '')
+    if not url:
+        return
+    headers = {surrogate_key_header(): ' '.join(keys)}
+    response = _session.get().request('PURGE', url, headers=headers,
+        timeout=Config.getdefault('edge', 'purge-timeout', 1.0, 'getfloat'))
+    if response.status_code >= 400:
+        app.logger.warning('Edge purge of %r got HTTP response %s.', keys, response.status_code)
+
+
+# vim: set ts=4 sts=4 sw=4 et:
@@ -0,0 +1,41 @@
+"""Helpers for running under preforking servers (e.g. gunicorn with preload_app)."""
+import os
+
+_process_locals = []
+
+class ProcessLocal(object):
+    """A value created lazily, once per process.
+
+    Clients holding sockets or connections must not be shared across a fork,
+    so the value is rebuilt whenever it is used from a different process than
+    the one which created it.
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.pid = None
+        self.value = None
+        _process_locals.append(self)
+
+    def get(self):
+        pid = os.getpid()
+        if self.pid != pid:
+            self.value = self.factory()
+            self.pid = pid
+        return self.value
+
+    def reset(self):
+        self.pid = None
+        self.value = None
+
+def post_fork():
+    """Drop any state inherited from the parent process.
+
+    Meant to be called from the server's post_fork hook; everything dropped
+    here is recreated lazily the first time the worker needs it.
+    """
+    for local in _process_locals:
+        local.reset()
+
+
+# vim: set ts=4 sts=4 sw=4 et:
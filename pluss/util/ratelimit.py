@@ -1,25 +1,260 @@
 import functools
+import math
+import socket
+import threading
+import time
+
+import flask
 
 from pluss.app import app
 from pluss.util.cache import Cache
+from pluss.util.config import Config
+from pluss.util.lifecycle import ProcessLocal
+
+# Shared per-minute request counters, keyed on scope, client and minute.
+RATE_LIMIT_CACHE_KEY_TEMPLATE = 'pluss--remoteip--ratelimit--3--%s--%s--%d'
+RATE_LIMIT_WINDOW = 60
+# Scope of the bucket shared by every route without a limit of its own.
+ALL_ROUTES = '*'
+
+class TokenBucket(object):
+    """A bucket holding up to `burst` tokens, refilled at `rate` tokens per second."""
+
+    def __init__(self, rate, burst, now):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = self.burst
+        self.stamp = now
+
+    def refill(self, now):
+        elapsed = now - self.stamp
+        if elapsed > 0:
+            self.tokens = min(self.burst, self.tokens + elapsed * self.rate)
+            self.stamp = now
+
+    def consume(self, now):
+        """Take a token. Returns 0 on success, or the seconds until one is available."""
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def drain(self, count):
+        """Remove tokens spent elsewhere (e.g. by other workers), going no lower than -burst."""
+        self.tokens = max(-self.burst, self.tokens - count)
+
+    @property
+    def full(self):
+        return self.tokens >= self.burst
+
+class ClientState(object):
+    """Local bucket plus the bookkeeping needed to sync it with the shared cache."""
+
+    def __init__(self, bucket):
+        self.bucket = bucket
+        self.pending = 0   # Requests not yet pushed to the shared counter
+        self.window = None # Shared counter window we last synced against
+        self.seen = 0      # Shared counter value as of our last sync
+        self.rejected = 0  # Requests rejected since the bucket was created
+
+def parse_limit(value):
+    """Parse a 'per-minute[/burst]' limit. Returns None for unlimited (per-minute of 0)."""
+    per_minute, _, burst = value.partition('/')
+    per_minute = float(per_minute)
+    if per_minute <= 0:
+        return None
+    burst = float(burst) if burst else per_minute
+    return (per_minute / 60.0, max(1.0, burst))
+
+def parse_address(addr):
+    """Convert an IP address into a (family bit width, integer) pair."""
+    for family, bits in ((socket.AF_INET, 32), (socket.AF_INET6, 128)):
+        try:
+            packed = socket.inet_pton(family, addr)
+        except (socket.error, ValueError):
+            continue
+        return bits, int(packed.encode('hex'), 16)
+    raise ValueError('Invalid IP address: %r' % addr)
+
+def parse_network(cidr):
+    """Convert a CIDR network into a (family bit width, prefix length, masked integer) tuple."""
+    addr, _, prefix = cidr.partition('/')
+    bits, value = parse_address(addr)
+    prefix = int(prefix) if prefix else bits
+    return bits, prefix, value >> (bits - prefix)
+
+def parse_overrides(option, parse_name=None):
+    """Parse a [ratelimit] option of whitespace-separated 'name=per-minute[/burst]' pairs."""
+    overrides = []
+    for entry in Config.getdefault('ratelimit', option, '').split():
+        name, _, limit = entry.rpartition('=')
+        try:
+            if not name:
+                raise ValueError('missing "="')
+            overrides.append((parse_name(name) if parse_name else name, parse_limit(limit)))
+        except ValueError as e:
+            raise ValueError('Invalid %s entry %r in the [ratelimit] config section'
+                ' (expected name=per-minute[/burst]): %s' % (option, entry, e))
+    return overrides
+
+def load_settings():
+    """Read the rate limiter's settings from the config file, failing loudly on mistakes."""
+    limit = '%s/%s' % (Config.getdefault('ratelimit', 'per-minute', '60'),
+        Config.getdefault('ratelimit', 'burst', '60'))
+    try:
+        default = parse_limit(limit)
+    except ValueError as e:
+        raise ValueError('Invalid per-minute/burst in the [ratelimit] config section: %s' % e)
+    return {
+        'default': default,
+        'routes': parse_overrides('routes'),
+        'networks': parse_overrides('networks', parse_network),
+        'sync_interval': Config.getdefault('ratelimit', 'sync-interval', 5, 'getint'),
+        'ipv6_prefix': Config.getdefault('ratelimit', 'ipv6-prefix', 64, 'getint'),
+    }
 
-RATE_LIMIT_CACHE_KEY_TEMPLATE = 'pluss--remoteip--ratelimit--1--%s'
+class RateLimiter(object):
+    """Per-process token bucket rate limiter.
+
+    Buckets are kept in memory so that checking a request never leaves the
+    process. Every `sync_interval` seconds, a background thread (a greenlet,
+    under gevent) adds the number of requests each client was let through to
+    a shared per-minute counter in the cache, and drains whatever other
+    workers spent in the meantime from the local buckets.
+
+    Each client has one bucket shared by all routes, plus one per route that
+    has its own limit in `routes`. `networks` holds (parse_network() result, limit) pairs.
+    """
+
+    def __init__(self, default, routes=(), networks=(), sync_interval=5, ipv6_prefix=64):
+        self.default = default
+        self.routes = dict(routes)
+        # Most specific networks first, so that the first match wins.
+        self.networks = sorted(networks, key=lambda n: -n[0][1])
+        self.sync_interval = sync_interval
+        self.ipv6_prefix = ipv6_prefix
+        self.clients = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        """Start syncing with the shared cache in the background."""
+        thread = threading.Thread(target=self.run, name='ratelimit-sync')
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def run(self):
+        while True:
+            time.sleep(self.sync_interval)
+            try:
+                self.sync(time.time())
+            except Exception:
+                app.logger.exception('Rate limiter sync failed.')
+
+    def limit_for(self, endpoint, addr):
+        """Find the bucket scope and (rate, burst) for a request; the limit is None if unlimited."""
+        try:
+            bits, value = parse_address(addr)
+        except ValueError:
+            bits, value = None, None
+        for (net_bits, prefix, network), limit in self.networks:
+            if bits == net_bits and value >> (bits - prefix) == network:
+                return ALL_ROUTES, limit
+        if endpoint in self.routes:
+            return endpoint, self.routes[endpoint]
+        return ALL_ROUTES, self.default
+
+    def client_key(self, addr):
+        """Identify a client. IPv6 clients are grouped by their routing prefix."""
+        try:
+            bits, value = parse_address(addr)
+        except ValueError:
+            return addr
+        if bits == 128 and self.ipv6_prefix < 128:
+            return '%x/%d' % (value >> (128 - self.ipv6_prefix), self.ipv6_prefix)
+        return addr
+
+    def check(self, endpoint, addr):
+        """Count a request. Returns 0 if it may proceed, otherwise seconds to wait."""
+        scope, limit = self.limit_for(endpoint, addr)
+        if limit is None:
+            return 0
+
+        now = time.time()
+        key = (scope, self.client_key(addr))
+        with self.lock:
+            state = self.clients.get(key)
+            if state is None:
+                state = self.clients[key] = ClientState(TokenBucket(limit[0], limit[1], now))
+            wait = state.bucket.consume(now)
+            if wait:
+                state.rejected += 1
+                if state.rejected in (1, 100, 1000, 10000):
+                    app.logger.info('Rate limited %s on %s - %d requests rejected.',
+                        key[1], endpoint, state.rejected)
+            else:
+                state.pending += 1
+        return wait
+
+    def sync(self, now):
+        """Push locally counted requests to the shared cache and drain others' usage."""
+        window = int(now // RATE_LIMIT_WINDOW)
+        with self.lock:
+            batch = []
+            for key, state in self.clients.items():
+                state.bucket.refill(now)
+                if not state.pending and state.bucket.full:
+                    # Idle client; forget about it to keep memory bounded.
+                    del self.clients[key]
+                    continue
+                if not state.pending:
+                    continue
+                if state.window != window:
+                    state.window, state.seen = window, 0
+                batch.append((key, state, state.pending))
+                state.pending = 0
+
+        if not Cache.client():
+            return
+
+        for key, state, count in batch:
+            cache_key = RATE_LIMIT_CACHE_KEY_TEMPLATE % (key[0], key[1], window)
+            total = Cache.incr(cache_key, count)
+            if total is None:
+                # First sync for this window; fall back to incr if another worker won the race.
+                if Cache.add(cache_key, count, time=2 * RATE_LIMIT_WINDOW):
+                    total = count
+                else:
+                    total = Cache.incr(cache_key, count)
+            if total is None:
+                continue
+            with self.lock:
+                others = int(total) - state.seen - count
+                state.seen = int(total)
+                if others > 0:
+                    state.bucket.drain(others)
+
+# Parsed at import, so that mistakes in the config show up at startup.
+settings = load_settings()
+
+# Buckets are per worker; a forked worker starts with a fresh limiter (and sync thread).
+limiter = ProcessLocal(lambda: RateLimiter(**settings).start())
 
 def ratelimited(func):
-    """Includes the wrapped handler in the global rate limiter (60 calls/min)."""
+    """Includes the wrapped handler in the rate limiter.
+
+    Must be applied below @app.route, so that the limited function is the one registered.
+    """
 
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
-        ratelimit_key = RATE_LIMIT_CACHE_KEY_TEMPLATE % flask.request.remote_addr
-        # Increment the existing minute's counter, or start a new one if none exists
-        # (relies on the short-circuiting of 'or')
-        remote_ip_rate = Cache.incr(ratelimit_key) or Cache.set(ratelimit_key, 1, time=60)
-        if remote_ip_rate > 60:
-            if remote_ip_rate in (61, 100, 1000, 10000):
-                app.logging.info('Rate limited %s - %d requests/min.',
-                    flask.request.remote_addr, remote_ip_rate)
-            message = 'Rate limit exceeded. Please do not make more than 60 requests per minute.'
-            return message, 503, {'Retry-After': 60} # Service Unavailable
+        wait = limiter.get().check(flask.request.endpoint, flask.request.remote_addr)
+        if wait:
+            retry_after = int(math.ceil(wait))
+            message = ('Rate limit exceeded. Please wait %d seconds before retrying.'
+                % retry_after)
+            return message, 429, {'Retry-After': str(retry_after)} # Too Many Requests
         return func(*args, **kwargs)
 
     return wrapper
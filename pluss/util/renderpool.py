@@ -0,0 +1,116 @@
+import multiprocessing
+import os
+import Queue
+import socket
+import traceback
+
+try:
+    from gevent.socket import wait_read
+except ImportError:
+    wait_read = None
+
+from pluss.util import lifecycle
+
+class RenderError(Exception):
+    """Raised when a job fails or times out in a render process."""
+
+class RenderPool(object):
+    """A pool of forked processes for running CPU-bound work off the event loop.
+
+    Each process runs `func` on the arguments it is sent over a pipe and sends
+    back the result. While waiting for the reply, only the calling greenlet
+    (or thread) is blocked, so the rest of the worker stays responsive.
+    """
+
+    def __init__(self, size, func, timeout):
+        self.func = func
+        self.timeout = timeout
+        self.idle = Queue.Queue()
+        for _ in range(size):
+            self.spawn()
+
+    def spawn(self):
+        conn, child_conn = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=serve, args=(child_conn, self.func))
+        process.daemon = True
+        process.start()
+        child_conn.close()
+        self.idle.put((process, conn))
+
+    def apply(self, *args):
+        """Run func(*args) in a render process and return its result.
+
+        Any failure, including a render process which has died, raises RenderError.
+        """
+        try:
+            process, conn = self.idle.get(timeout=self.timeout)
+        except Queue.Empty:
+            raise RenderError('No render process became free within %ss.' % self.timeout)
+
+        healthy = False
+        try:
+            conn.send(args)
+            if not wait_readable(conn, self.timeout):
+                raise RenderError('Render process timed out after %ss.' % self.timeout)
+            ok, result = conn.recv()
+            healthy = True
+        except RenderError:
+            raise
+        except Exception as e:
+            raise RenderError('Render process failed: %r' % e)
+        finally:
+            # Always hand the process back, or replace it if it is dead or in an
+            # unknown state (including when we were interrupted mid-job, e.g. by
+            # a gevent.Timeout), so that the pool never shrinks.
+            if healthy:
+                self.idle.put((process, conn))
+            else:
+                process.terminate()
+                conn.close()
+                self.spawn()
+        if not ok:
+            raise RenderError(result)
+        return result
+
+def wait_readable(conn, timeout):
+    """Wait for a reply on conn, cooperatively if running under gevent."""
+    if wait_read is None:
+        return conn.poll(timeout)
+    try:
+        wait_read(conn.fileno(), timeout=timeout)
+    except socket.timeout:
+        return False
+    return True
+
+def close_inherited_fds(keep):
+    """Close every file descriptor except stdio and `keep`.
+
+    Render processes are forked from a worker which is already serving, and
+    would otherwise hold its listener, memcache connections and client
+    connections open (so clients never see EOF) for as long as they live.
+    """
+    try:
+        max_fd = os.sysconf('SC_OPEN_MAX')
+    except (AttributeError, ValueError):
+        max_fd = 256
+    os.closerange(3, keep)
+    os.closerange(keep + 1, max_fd)
+
+def serve(conn, func):
+    """Main loop of a render process."""
+    close_inherited_fds(conn.fileno())
+    lifecycle.post_fork()
+    while True:
+        try:
+            args = conn.recv()
+        except EOFError:
+            # Our worker went away.
+            return
+        try:
+            reply = (True, func(*args))
+        except Exception:
+            reply = (False, traceback.format_exc())
+        conn.send(reply)
+
+
+# vim: set ts=4 sts=4 sw=4 et: